@@ -10,29 +10,34 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
-import distutils.spawn
-import dotenv
+import hashlib
 import json
 import os
 import platform
 import re
-import shutil
-import stat
-import subprocess
 import sys
-import tempfile
-import urllib.request
-import zipfile
+
+_CHROME_VER_RE = re.compile(r'Google Chrome ?(for Testing)? ([0-9.]+)')
+_PATH_VER_RE = re.compile(r'(?:linux|linux_arm|linux64|mac|mac_arm|mac-x64|mac-arm64|win32|win64)-(\d+\.\d+\.\d+\.\d+)')
+_ENV_COMMENT_RE = re.compile(r'\s+#.*$')
+_ENV_DOUBLE_QUOTED_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_ENV_ESCAPE_RE = re.compile(r'\\(["\\])')
 
 class ChromeDriverFetcher:
     downloadsFile = "https://googlechromelabs.github.io/chrome-for-testing/known-good-versions-with-downloads.json"
 
     platform = None
     chromeVersion = None
+    versionData = None
+    versionsByNumber = None
+    versionsByBuild = None
+    patchNumbersByBuild = None
 
     chromedriverArgs = []
     cacheDir = None
     pathToChrome = None
+    chromePath = None
+    targetPath = None
 
     def __init__(
             self,
@@ -64,25 +69,131 @@ class ChromeDriverFetcher:
     def getChromePath(self):
         if (self.pathToChrome is not None):
             return self.pathToChrome
+        if (self.chromePath is not None):
+            return self.chromePath
+
         if (sys.platform == 'darwin'):
-            return "/Applications/Google Chrome for Testing.app/Contents/MacOS/Google Chrome for Testing"
+            self.chromePath = "/Applications/Google Chrome for Testing.app/Contents/MacOS/Google Chrome for Testing"
         elif (sys.platform == 'linux'):
-            return distutils.spawn.find_executable("google-chrome-stable")
+            import shutil
+            self.chromePath = shutil.which("google-chrome-stable")
+        else:
+            raise ValueError("Unable to find Chrome on %s" % ( sys.platform ))
 
-        raise ValueError("Unable to find Chrome on %s" % ( sys.platform ))
+        return self.chromePath
 
     def getChromeVersion(self):
-        versionOutput = subprocess.check_output([self.getChromePath(), '--version'])
+        if (self.chromeVersion is not None):
+            return self.chromeVersion
+
+        chromePath = self.getChromePath()
+        if (chromePath is not None):
+            self.chromeVersion = self.getChromeVersionFromInstall(chromePath)
+            if (self.chromeVersion is not None):
+                return self.chromeVersion
+
+        import subprocess
+        versionOutput = subprocess.check_output([chromePath, '--version'])
         versionOutput = versionOutput.decode()
-        versionString = re.search('Google Chrome ?(for Testing)? ([0-9.]+)', versionOutput).group(2).strip()
+        self.chromeVersion = _CHROME_VER_RE.search(versionOutput).group(2).strip()
 
-        return versionString
+        return self.chromeVersion
+
+    def getChromeVersionFromInstall(self, chromePath):
+        # Versioned installs, such as those from @puppeteer/browsers, are kept in a <platform>-<version> directory.
+        for pathComponent in chromePath.split(os.sep):
+            pathVersion = _PATH_VER_RE.fullmatch(pathComponent)
+            if (pathVersion is not None):
+                return pathVersion.group(1)
+
+        # macOS application bundles record their version in Info.plist.
+        bundlePath, separator, _ = chromePath.partition('.app/Contents/MacOS/')
+        if (separator):
+            plistPath = "%s.app/Contents/Info.plist" % ( bundlePath )
+            if (os.path.isfile(plistPath)):
+                import plistlib
+                with open(plistPath, 'rb') as f:
+                    return plistlib.load(f).get('CFBundleShortVersionString')
+
+        return None
 
     def getVersionData(self):
-        response = urllib.request.urlopen(self.downloadsFile).read()
-        return json.loads(response.decode('utf-8'))
+        if (self.versionData is not None):
+            return self.versionData
+
+        import urllib.error
+        import urllib.request
+
+        cachePath = os.path.join(self.cacheDir, 'known-good-versions.json')
+        headersPath = "%s.headers" % ( cachePath )
+
+        # Revalidate any cached copy of the downloads file rather than fetching it in full every time.
+        request = urllib.request.Request(self.downloadsFile)
+        if (os.path.isfile(cachePath) and os.path.isfile(headersPath)):
+            with open(headersPath, 'r') as f:
+                cachedHeaders = json.load(f)
+            if (cachedHeaders.get('ETag') is not None):
+                request.add_header('If-None-Match', cachedHeaders.get('ETag'))
+            if (cachedHeaders.get('Last-Modified') is not None):
+                request.add_header('If-Modified-Since', cachedHeaders.get('Last-Modified'))
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                content = response.read()
+                responseHeaders = {
+                    'ETag': response.headers.get('ETag'),
+                    'Last-Modified': response.headers.get('Last-Modified'),
+                }
+        except urllib.error.HTTPError as e:
+            if (e.code != 304):
+                raise
+            e.close()
+            with open(cachePath, 'rb') as f:
+                content = f.read()
+        else:
+            self.writeCacheFile(cachePath, content)
+            self.writeCacheFile(headersPath, json.dumps(responseHeaders).encode('utf-8'))
+
+        self.versionData = json.loads(content.decode('utf-8'))
+        self.indexVersionData()
+
+        return self.versionData
+
+    def indexVersionData(self):
+        # Index the versions by their full number, and by their major.minor.build prefix ordered by patch number.
+        self.versionsByNumber = {}
+        self.versionsByBuild = {}
+        for versionData in self.versionData['versions']:
+            self.versionsByNumber[versionData['version']] = versionData
+            buildVersion = versionData['version'].rpartition('.')[0]
+            self.versionsByBuild.setdefault(buildVersion, []).append(versionData)
+
+        self.patchNumbersByBuild = {}
+        for buildVersion, possibleVersions in self.versionsByBuild.items():
+            possibleVersions.sort(key=self.getPatchNumber)
+            self.patchNumbersByBuild[buildVersion] = [self.getPatchNumber(versionData) for versionData in possibleVersions]
+
+    def getPatchNumber(self, versionData):
+        return int(versionData['version'].rpartition('.')[2])
+
+    def writeCacheFile(self, path, content):
+        import tempfile
+
+        # Write to a unique file in the same directory so that concurrent runs never share a partial file.
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            # mkstemp creates owner-only files. Cache files may be shared with other users, so make them readable.
+            os.chmod(tempPath, 0o644)
+            os.replace(tempPath, path)
+        except BaseException:
+            os.remove(tempPath)
+            raise
 
     def getLegacyChromedriverUrl(self):
+        import urllib.request
+
         version = self.chromeVersion.split('.')
         version.pop()
         version = '.'.join(version)
@@ -111,36 +222,31 @@ class ChromeDriverFetcher:
 
 
     def getClosestVersionMatch(self):
-        content = self.getVersionData()
+        import bisect
 
-        majorMinorVersion = self.chromeVersion.split('.')
-        majorMinorVersion.pop()
-        majorMinorVersion = '.'.join(majorMinorVersion)
+        self.getVersionData()
 
-        possibleVersions = []
-        for versionData in content['versions']:
-            if (versionData['version'] == self.chromeVersion):
-                # Exact match. Return immediately.
-                print("Exact match found for %s" % ( self.chromeVersion ))
-                return versionData
+        versionData = self.versionsByNumber.get(self.chromeVersion)
+        if (versionData is not None):
+            # Exact match. Return immediately.
+            print("Exact match found for %s" % ( self.chromeVersion ))
+            return versionData
 
-            if (versionData['version'].startswith(majorMinorVersion)):
-                print("Possible match found for %s at %s" % ( self.chromeVersion, versionData['version'] ) )
-                possibleVersions.insert(0, versionData)
+        # No exact version found. Try and find the closest older version instead.
+        buildVersion, _, patchNumber = self.chromeVersion.rpartition('.')
+        patchNumbers = self.patchNumbersByBuild.get(buildVersion, [])
+        index = bisect.bisect_right(patchNumbers, int(patchNumber))
+        if (index == 0):
+            return None
 
-        # No exact version found. Try and find the closing older version instead.
-        patchNumber = int(self.chromeVersion.split('.')[3])
-
-        for versionData in possibleVersions:
-            thisPatchNumber = int(versionData['version'].split('.')[3])
-            if (thisPatchNumber > patchNumber):
-                 # Newer version. Skip.
-                 continue
-
-            # This is not an exact match, and it's not a newer version. It's the best match.
-            return versionData;
+        versionData = self.versionsByBuild[buildVersion][index - 1]
+        print("Closest match found for %s at %s" % ( self.chromeVersion, versionData['version'] ))
+        return versionData
 
     def getPlatform(self):
+        if (self.platform is not None):
+            return self.platform
+
         if (sys.platform == 'darwin'):
             return "mac-%s" % platform.machine()
         if (sys.platform.startswith('linux')):
@@ -153,55 +259,100 @@ class ChromeDriverFetcher:
             return "win32"
         raise RuntimeError("Unable to find a chromedriver download for %s" % ( sys.platform ))
 
-    def getZipPath(self, targetDirectory):
-        return "%s/chromedriver.zip" % ( targetDirectory.name )
-
-    def downloadChromeDriver(self):
-        print("Downloading chromedriver for Chrome %s on %s" % ( self.chromeVersion, self.platform ))
-        url = self.getChromedriverUrl()
-
-        targetDirectory = tempfile.TemporaryDirectory()
-        targetFile = self.getZipPath(targetDirectory)
-
-        print("Fetching from %s to %s" % ( url, targetFile ))
-        urllib.request.urlretrieve(url, targetFile)
-
-        return targetDirectory
-
-    def getPathInZip(self, targetDirectory):
+    def getPathInZip(self):
         majorVersion = int(self.chromeVersion.split('.')[0])
         if (majorVersion <= 114):
-            return "%s/chromedriver" % ( targetDirectory.name )
+            return "chromedriver"
 
-        return "%s/chromedriver-%s/chromedriver" % ( targetDirectory.name, self.platform )
+        return "chromedriver-%s/chromedriver" % ( self.platform )
 
     def getTargetPath(self):
-        return "%s/chromedriver_%s_%s" % (
-            self.cacheDir,
-            self.platform,
-            self.chromeVersion,
-        )
+        if (self.targetPath is None):
+            self.targetPath = "%s/chromedriver_%s_%s" % (
+                self.cacheDir,
+                self.platform,
+                self.chromeVersion,
+            )
+
+        return self.targetPath
 
     def downloadAndUnzipChromeDriver(self):
-        targetDirectory = self.downloadChromeDriver()
-        zipFile = self.getZipPath(targetDirectory)
-        with zipfile.ZipFile(zipFile, 'r') as zip_ref:
-            zip_ref.extractall(targetDirectory.name)
-
-            targetFile = self.getTargetPath()
-            shutil.copyfile(
-                self.getPathInZip(targetDirectory),
-                targetFile,
-            )
+        # These are only needed when a driver has to be fetched, so keep them off the cached startup path.
+        import io
+        import shutil
+        import tempfile
+        import urllib.request
+        import zipfile
+
+        url = self.getChromedriverUrl()
+        targetFile = self.getTargetPath()
+        print("Downloading chromedriver for Chrome %s on %s\nFetching from %s to %s" % (
+            self.chromeVersion,
+            self.platform,
+            url,
+            targetFile,
+        ))
+
+        # The zip central directory lives at the end of the archive, so buffer the response in memory rather
+        # than writing it to a temporary file, and extract only the chromedriver binary from it.
+        with urllib.request.urlopen(url) as response:
+            archive = io.BytesIO(response.read())
+
+        # Extract to a unique file alongside the target and rename it into place, so that a partial file is never
+        # left at the target and concurrent runs do not write to the same file.
+        fd, tempFile = tempfile.mkstemp(dir=self.cacheDir, prefix=os.path.basename(targetFile))
+        try:
+            with os.fdopen(fd, 'wb') as target, zipfile.ZipFile(archive, 'r') as zip_ref:
+                with zip_ref.open(self.getPathInZip()) as source:
+                    shutil.copyfileobj(source, target, length=1024 * 1024)
+
+            os.chmod(tempFile, 0o755)
+
+            # Record the checksum before the driver is moved into place, so the driver never exists without it.
+            digest = self.getFileDigest(tempFile)
+            self.writeCacheFile(self.getChecksumPath(targetFile), digest.encode('utf-8'))
+            os.replace(tempFile, targetFile)
+        finally:
+            if (os.path.exists(tempFile)):
+                os.remove(tempFile)
+
+    def getChecksumPath(self, targetFile):
+        return "%s.sha256" % ( targetFile )
+
+    def getFileDigest(self, targetFile):
+        with open(targetFile, 'rb') as f:
+            if (hasattr(hashlib, 'file_digest')):
+                return hashlib.file_digest(f, 'sha256').hexdigest()
+
+            # hashlib.file_digest is only available from Python 3.11.
+            digest = hashlib.sha256()
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+
+    def isDriverValid(self, driverPath):
+        if (not os.path.isfile(driverPath) or not os.access(driverPath, os.X_OK)):
+            return False
+
+        checksumPath = self.getChecksumPath(driverPath)
+        if (not os.path.isfile(checksumPath)):
+            # Drivers cached before checksums were recorded are trusted as they are.
+            return True
 
-            st = os.stat(targetFile)
-            os.chmod(targetFile, st.st_mode | stat.S_IEXEC)
+        try:
+            with open(checksumPath, 'r') as f:
+                return f.read().strip() == self.getFileDigest(driverPath)
+        except OSError:
+            # An unreadable checksum or driver cannot be verified.
+            return False
 
     def getOptions(self):
         if (not os.path.isfile(".env") and os.path.isfile('chromedriver.conf')):
             raise RuntimeError("Legacy chromedriver.conf file found. Please convert this to a .env file.")
 
-        config = dotenv.dotenv_values(".env")
+        config = {}
+        if (os.path.isfile(".env")):
+            config = self.parseEnvFile(".env")
 
         if (config.get('EXTRA_OPTIONS') is not None):
             self.chromedriverArgs = config.get('EXTRA_OPTIONS').split(' ')
@@ -215,13 +366,43 @@ class ChromeDriverFetcher:
 
         return config
 
+    def parseEnvFile(self, path):
+        config = {}
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if (not line or line.startswith('#')):
+                    continue
+                if (line.startswith('export ')):
+                    line = line[len('export '):]
+
+                key, separator, value = line.partition('=')
+                if (not separator):
+                    continue
+
+                value = value.strip()
+                doubleQuoted = _ENV_DOUBLE_QUOTED_RE.match(value)
+                if (doubleQuoted is not None):
+                    # Double-quoted values may contain escaped quotes and backslashes.
+                    value = _ENV_ESCAPE_RE.sub(r'\1', doubleQuoted.group(1))
+                elif (value[:1] in ('"', "'")):
+                    # Quoted values run to the closing quote. Anything after it, such as a comment, is ignored.
+                    closingQuote = value.find(value[0], 1)
+                    if (closingQuote != -1):
+                        value = value[1:closingQuote]
+                else:
+                    value = _ENV_COMMENT_RE.sub('', value)
+                config[key.strip()] = value
+
+        return config
+
     def executeDriver(self):
         driverPath = self.getTargetPath()
-        if (not os.path.isfile(driverPath) or not os.access(driverPath, os.X_OK)):
+        if (not self.isDriverValid(driverPath)):
             self.downloadAndUnzipChromeDriver()
 
-        subprocess.run(
-            self.chromedriverArgs,
-            executable=driverPath,
-            shell=True,
-        )
+        # Replace this process with chromedriver rather than running it beneath a shell. Anything still buffered
+        # on stdout or stderr is lost by execv, so flush it first.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(driverPath, [driverPath, *self.chromedriverArgs])